@@ -4,11 +4,17 @@ import sys
 import os
 import random
 import signal
+import select
+import errno
+import fcntl
 import time
-import sched
-import ESL
+import threading
+import Queue
+import socket
+import urllib
 import logging
-import uuid
+import binascii
+from collections import defaultdict, deque
 from optparse import OptionParser
 
 """
@@ -19,52 +25,254 @@ TODO
 - Implement sipp return codes (0 for success, 1 call failed, etc etc)
 """
 
-class FastScheduler(sched.scheduler):
+# Max events processed per wakeup before giving originate_sessions a chance to run
+EVENT_BATCH_MAX = 1000
+
+# Event header names looked up for every event we receive
+EVENT_NAME_HDR = intern('Event-Name')
+EVENT_SUBCLASS_HDR = intern('Event-Subclass')
+UNIQUE_ID_HDR = intern('Unique-ID')
+HANGUP_CAUSE_HDR = intern('Hangup-Cause')
+
+def fast_uuid():
+    """
+    Return a random UUID in its string form, FreeSWITCH only ever
+    sees the string so skip building (and formatting) a uuid.UUID
+    """
+    h = binascii.hexlify(os.urandom(16))
+    return '%s-%s-%s-%s-%s' % (h[0:8], h[8:12], h[12:16], h[16:20], h[20:32])
+
+class ESLEvent(object):
+    """
+    Event or reply packet read from the event socket. Headers are not
+    split into a dict, getHeader() looks them up in the raw text on
+    demand as we only ever need a few of them per event
+    """
+    __slots__ = ('raw', 'body')
+
+    def __init__(self, raw, body=''):
+        # raw is the header block, starting and ending with a new line
+        self.raw = raw
+        self.body = body
+
+    def getHeader(self, name):
+        raw = self.raw
+        key = '\n%s: ' % name
+        start = raw.find(key)
+        if start < 0:
+            return None
+        start = start + len(key)
+        value = raw[start:raw.find('\n', start)]
+        if '%' in value:
+            value = urllib.unquote(value)
+        return value
+
+class ESLConnection(object):
+    """
+    Client for the FreeSWITCH event socket plain text protocol, exposing
+    the subset of the ESL.ESLconnection API this script uses plus
+    sendPipelined(). Replies to pipelined commands are discarded as they
+    arrive and events received while waiting for a reply are queued for
+    recvEventTimed()
+    """
+    def __init__(self, host, port, password):
+        self.sock = None
+        self.buf = ''
+        self.pos = 0
+        self.event_queue = deque()
+        self.pending_replies = 0
+        try:
+            self.sock = socket.create_connection((host, int(port)))
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            packet = self.read_packet(None)
+            if packet is None or packet.getHeader('Content-Type') != 'auth/request':
+                self.disconnect()
+                return
+            reply = self.command('auth %s' % password)
+            if reply is None or not reply.startswith('+OK'):
+                self.disconnect()
+        except socket.error:
+            self.disconnect()
+
+    def connected(self):
+        return self.sock is not None
+
+    def socketDescriptor(self):
+        if self.sock is None:
+            return -1
+        return self.sock.fileno()
 
-    def __init__(self, timefunc, delayfunc):
-        self.queue = []
-        # Do not use super() as sched.scheduler does not inherit from object
-        sched.scheduler.__init__(self, timefunc, delayfunc)
-        if sys.version_info[0] == 2 and sys.version_info[1] >= 6:
-            """
-            Python 2.6 renamed the sched member queue to _queue, lets
-            keep the old name in our class
-            """
-            self.queue = self._queue
+    def disconnect(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
 
-    def next_event_time_delta(self):
+    def fill(self, timeout):
         """
-        Return the time delta in seconds for the next event
-        to become ready for execution
+        Read more data into our buffer, waiting at most timeout seconds
+        (forever if None). Return False if nothing could be read
         """
-        q = self.queue
-        if len(q) <= 0:
-            return -1
-        time, priority, action, argument = q[0]
-        now = self.timefunc()
-        if time > now:
-            return int(time - now)
-        return 0
+        sock = self.sock
+        if sock is None:
+            return False
+        try:
+            if timeout is not None and not select.select([sock], [], [], timeout)[0]:
+                return False
+            data = sock.recv(65536)
+        except (select.error, socket.error), ex:
+            if ex.args[0] == errno.EINTR:
+                return False
+            self.disconnect()
+            return False
+        if not data:
+            self.disconnect()
+            return False
+        self.buf = self.buf[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def read_packet(self, timeout):
+        """
+        Return the next packet as an ESLEvent or None if there is none
+        within timeout seconds (forever if None)
+        """
+        deadline = None
+        while True:
+            buf = self.buf
+            pos = self.pos
+            end = buf.find('\n\n', pos)
+            if end >= 0:
+                packet = ESLEvent('\n' + buf[pos:end + 1])
+                length = packet.getHeader('Content-Length')
+                start = end + 2
+                stop = start + int(length) if length else start
+                if stop <= len(buf):
+                    packet.body = buf[start:stop]
+                    self.pos = stop
+                    return packet
+            if timeout is not None:
+                now = time.time()
+                if deadline is None:
+                    deadline = now + timeout
+                elif now >= deadline:
+                    return None
+                timeout = deadline - now
+            if not self.fill(timeout):
+                # Keep retrying only when interrupted while blocking
+                if timeout is not None or self.sock is None:
+                    return None
+
+    def read_reply(self):
+        """
+        Return the reply to the last command sent, skipping replies to
+        pipelined commands and queueing any event received meanwhile
+        """
+        while True:
+            packet = self.read_packet(None)
+            if packet is None:
+                return None
+            ctype = packet.getHeader('Content-Type')
+            if ctype == 'command/reply' or ctype == 'api/response':
+                if self.pending_replies:
+                    self.pending_replies = self.pending_replies - 1
+                    continue
+                if ctype == 'api/response':
+                    return packet.body
+                return packet.getHeader('Reply-Text')
+            event = self.parse_event(packet, ctype)
+            if event is not None:
+                self.event_queue.append(event)
+
+    def parse_event(self, packet, ctype):
+        if ctype == 'text/event-plain':
+            body = packet.body
+            # Event headers end at the first empty line, an event body may follow
+            end = body.find('\n\n')
+            if end < 0:
+                return ESLEvent('\n' + body)
+            return ESLEvent('\n' + body[:end + 1], body[end + 2:])
+        if ctype == 'text/disconnect-notice':
+            self.disconnect()
+        return None
+
+    def send(self, data):
+        if self.sock is None:
+            return False
+        try:
+            self.sock.sendall(data)
+        except socket.error:
+            self.disconnect()
+            return False
+        return True
+
+    def command(self, cmd):
+        if not self.send(cmd + '\n\n'):
+            return None
+        return self.read_reply()
+
+    def sendPipelined(self, cmds):
+        """
+        Send all the commands with a single write without waiting for
+        their replies, which are dropped whenever they arrive. Return
+        False if they could not be sent
+        """
+        if not self.send('\n\n'.join(cmds) + '\n\n'):
+            return False
+        self.pending_replies = self.pending_replies + len(cmds)
+        return True
+
+    def api(self, cmd):
+        return self.command('api %s' % cmd)
+
+    def events(self, etype, value):
+        return self.command('event %s %s' % (etype, value))
 
-    def fast_run(self):
+    def pending(self):
+        """
+        Return True if a packet can be read without waiting on the socket,
+        either an event queued while waiting for a reply or a complete
+        packet already in our buffer, neither makes the socket readable
+        """
+        if self.event_queue:
+            return True
+        buf = self.buf
+        pos = self.pos
+        end = buf.find('\n\n', pos)
+        if end < 0:
+            return False
+        length = ESLEvent('\n' + buf[pos:end + 1]).getHeader('Content-Length')
+        return not length or end + 2 + int(length) <= len(buf)
+
+    def recvEventTimed(self, ms):
         """
-        Try to run events that are ready only and return immediately
-        It is assumed that the callbacks will not block and the time
-        is only retrieved once (when entering the function) and not
-        before executing each event, so there is a chance an event
-        that becomes ready while looping will not get executed
+        Return the next event, waiting at most ms milliseconds for
+        it, unlike libesl a timeout of 0 does not block at all
         """
-        q = self.queue
-        now = self.timefunc()
-        while q:
-            time, priority, action, argument = q[0]
-            if now < time:
-                break
-            if now >= time:
-                self.cancel(q[0])
-                void = action(*argument)
+        if self.event_queue:
+            return self.event_queue.popleft()
+        deadline = time.time() + ms / 1000.0
+        while True:
+            packet = self.read_packet(max(deadline - time.time(), 0))
+            if packet is None:
+                return None
+            ctype = packet.getHeader('Content-Type')
+            if ctype == 'command/reply' or ctype == 'api/response':
+                if self.pending_replies:
+                    self.pending_replies = self.pending_replies - 1
+                continue
+            event = self.parse_event(packet, ctype)
+            if event is not None:
+                return event
+            if self.sock is None:
+                return None
 
 class Session(object):
+    __slots__ = ('uuid', 'partner_uuid', 'created', 'answered',
+                 'bert_sync_lost_cnt', 'bert_timeout')
+
     def __init__(self, uuid):
         self.uuid = uuid
         self.partner_uuid = None
@@ -91,22 +299,35 @@ class SessionManager(object):
         self.time_rate = time_rate
         self.report_interval = report_interval
         self.originate_string = originate_string
+        self.debug = debug
         self.logger = logger
         self.test_id_var = 'fs_test'
-        self.test_id = uuid.uuid1()
+        self.test_id = fast_uuid()
         self.test_uuid_x_header = 'sip_h_X-fs_test_uuid'
+        # Channel variable carrying our X header, read on every CHANNEL_CREATE
+        self.test_uuid_var = intern('variable_%s' % (self.test_uuid_x_header))
         self.bert_sync_lost_var = 'bert_stats_sync_lost'
 
+        # Maps both our originated uuid and its peer (bridged) uuid to
+        # the same Session, Session.uuid tells which side a uuid is
         self.sessions = {}
-        self.peer_sessions = {}
-        self.hangup_causes = {}
+        self.active_sessions = 0
+        self.hangup_causes = defaultdict(int)
         self.total_originated_sessions = 0
         self.total_answered_sessions = 0
         self.total_failed_sessions = 0
         self.terminate = False
         self.paused = 0
+        # Bind the CHANNEL_ORIGINATE handler variant we need once
+        # instead of checking for a DTMF sequence on every originate
+        if self.dtmf_seq:
+            handle_originate = self.handle_originate_dtmf
+            self.sched_dtmf_template = 'api sched_api +%d none uuid_send_dtmf %%s %s' % (
+                    self.dtmf_delay, self.dtmf_seq.replace('%', '%%'))
+        else:
+            handle_originate = self.handle_originate
         self.ev_handlers = {
-            'CHANNEL_ORIGINATE': self.handle_originate,
+            'CHANNEL_ORIGINATE': handle_originate,
             'CHANNEL_CREATE': self.handle_create,
             'CHANNEL_ANSWER': self.handle_answer,
             'CHANNEL_BRIDGE': self.handle_answer,
@@ -119,25 +340,61 @@ class SessionManager(object):
             'mod_bert::lost_sync': self.handle_bert_lost_sync,
         }
 
+        # Self-pipe written by the C level signal handler so that run() is
+        # woken up from select() right away on SIGTSTP (pause/resume)
+        self.wakeup_fds = os.pipe()
+        for fd in self.wakeup_fds:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.set_wakeup_fd(self.wakeup_fds[1])
         signal.signal(signal.SIGTSTP, self.pause_resume_calls)
 
-        self.sched = FastScheduler(time.time, time.sleep)
+        # Periodic reports (--report) are logged from a background thread
+        # so that the event loop does not stall on them
+        self.report_queue = Queue.Queue()
+        self.report_lock = threading.Lock()
+        report_thread = threading.Thread(target=self.report_worker)
+        report_thread.daemon = True
+        report_thread.start()
+
+        # When originate_sessions is due next, None once we are done originating
+        self.next_originate = None
         # Initialize the ESL connection
-        self.con = ESL.ESLconnection(self.server, self.port, self.auth)
+        self.con = ESLConnection(self.server, self.port, self.auth)
         if not self.con.connected():
             logger.error('Failed to connect!')
             raise Exception
 
+        if debug:
+            logger.setLevel(logging.DEBUG)
+        self.setup_connection()
+
+        # Fix up the originate string to add our identifier
+        if self.originate_string[0] == '{':
+            self.originate_string = '{%s=%s,%s' % (self.test_id_var, self.test_id, self.originate_string[1:])
+        else:
+            self.originate_string = '{%s=%s}%s' % (self.test_id_var, self.test_id, self.originate_string)
+        self.logger.debug('Originate string: %s', self.originate_string)
+
+        # Per session originate command, only the uuids are filled in per call.
+        # Escape '%' as it is common in originate strings (i.e profile%host)
+        self.originate_template = 'bgapi originate {origination_uuid=%%s,%s=%%s,%s' % (
+                self.test_uuid_x_header, self.originate_string[1:].replace('%', '%%'))
+
+    def setup_connection(self):
+        """
+        Configure the server and subscribe to our events, needed on
+        every new ESL connection (including after reconnect())
+        """
         # Raise the sps and max_sessions limit to make sure they do not obstruct our test
         self.con.api('fsctl sps %d' % 100000)
         self.con.api('fsctl max_sessions %d' % 100000)
         self.con.api('fsctl verbose_events true')
 
         # Reduce logging level to avoid much output in console/logfile
-        if debug:
+        if self.debug:
             self.con.api('fsctl loglevel debug')
             self.con.api('console loglevel debug')
-            logger.setLevel(logging.DEBUG)
         else:
             self.con.api('fsctl loglevel warning')
             self.con.api('console loglevel warning')
@@ -146,19 +403,12 @@ class SessionManager(object):
         self.con.api('reloadxml')
 
         # Register relevant events to get notified about our sessions created/destroyed
-        #self.con.events('plain', 'CHANNEL_ORIGINATE CHANNEL_ANSWER CHANNEL_HANGUP CUSTOM')
-        for key, val in self.ev_handlers.iteritems():
-            self.con.events('plain', key)
-        for key, val in self.custom_ev_handlers.iteritems():
-            evstr = 'CUSTOM %s' % (key)
-            self.con.events('plain', evstr)
-
-        # Fix up the originate string to add our identifier
-        if self.originate_string[0] == '{':
-            self.originate_string = '{%s=%s,%s' % (self.test_id_var, str(self.test_id), self.originate_string[1:])
-        else:
-            self.originate_string = '{%s=%s}%s' % (self.test_id_var, str(self.test_id), self.originate_string)
-        self.logger.debug('Originate string: %s' % self.originate_string)
+        # with a single command. Every name after CUSTOM is taken as a subclass
+        # so it has to go last, followed by the custom subclasses we handle
+        evnames = [key for key in self.ev_handlers if key != 'CUSTOM']
+        evnames.append('CUSTOM')
+        evnames.extend(self.custom_ev_handlers)
+        self.con.events('plain', ' '.join(evnames))
 
     def pause_resume_calls(self, signum, frame):
         if self.paused:
@@ -171,158 +421,245 @@ class SessionManager(object):
             if self.paused == 1:
                 self.logger.info('... Paused ...')
             self.paused = self.paused + 1
-            self.sched.enter(1, 1, self.originate_sessions, [])
+            self.next_originate = time.time() + 1
             return
         if not self.con.connected():
             self.reconnect()
         self.logger.debug('Originating sessions')
         if self.max_sessions and self.total_originated_sessions >= self.max_sessions:
             self.logger.info('Done originating sessions')
+            self.next_originate = None
             return
-        sesscnt = len(self.sessions)
-        originated_sessions = 0
-        for i in range(0, self.rate):
-            if sesscnt >= self.limit:
-                break
-            originate_uuid = uuid.uuid1()
-            originate_string = '{origination_uuid=%s,%s=%s,%s' % (str(originate_uuid),
-                                self.test_uuid_x_header, str(originate_uuid), self.originate_string[1:])
-            self.sessions[str(originate_uuid)] = Session(originate_uuid)
-            self.con.api('bgapi originate %s' % (originate_string))
-            sesscnt = sesscnt + 1
-            originated_sessions = originated_sessions + 1
-            self.logger.debug('Requested session %s (%s)' % (originate_uuid, originate_string))
-        if originated_sessions:
-            self.logger.info('Originated %d new sessions', originated_sessions)
+        originated_sessions = min(self.rate, self.limit - self.active_sessions)
+        if originated_sessions > 0:
+            # This loop runs rate times per tick, keep everything it uses in locals
+            template = self.originate_template
+            # Only track the new sessions once their originates are sent
+            sessions = {}
+            logger = self.logger
+            debug = logger.isEnabledFor(logging.DEBUG)
+            cmds = []
+            append = cmds.append
+            for i in xrange(originated_sessions):
+                originate_uuid = fast_uuid()
+                originate_cmd = template % (originate_uuid, originate_uuid)
+                sessions[originate_uuid] = Session(originate_uuid)
+                append(originate_cmd)
+                if debug:
+                    logger.debug('Requested session %s (%s)', originate_uuid, originate_cmd)
+            if self.con.sendPipelined(cmds):
+                self.sessions.update(sessions)
+                self.active_sessions = self.active_sessions + originated_sessions
+                self.logger.info('Originated %d new sessions', originated_sessions)
+            else:
+                self.logger.error('Failed to send %d originates', originated_sessions)
         self.logger.debug('Done originating sessions')
-        self.sched.enter(self.time_rate, 1, self.originate_sessions, [])
+        self.next_originate = time.time() + self.time_rate
 
     def process_event(self, e):
-        evname = e.getHeader('Event-Name')
-        if evname in self.ev_handlers:
-            try:
-                self.ev_handlers[evname](e)
-            except Exception, ex:
-                self.logger.error('Failed to process event %s: %s' % (evname, ex))
-        else:
-            self.logger.error('Unknown event %s' % (evname))
+        evname = e.getHeader(EVENT_NAME_HDR)
+        handler = self.ev_handlers.get(evname)
+        if handler is None:
+            self.logger.error('Unknown event %s', evname)
+            return
+        try:
+            handler(e)
+        except Exception, ex:
+            self.logger.error('Failed to process event %s: %s', evname, ex)
 
     def handle_custom(self, e):
-        evname = e.getHeader('Event-Name')
-        subclass = e.getHeader('Event-Subclass')
-        if subclass in self.custom_ev_handlers:
-            try:
-                self.custom_ev_handlers[subclass](e)
-            except Exception, ex:
-                self.logger.error('Failed to process event %s/%s: %s' % (evname, subclass, ex))
-        else:
-            self.logger.error('Unknown event %s/%s' % (evname, subclass))
+        subclass = e.getHeader(EVENT_SUBCLASS_HDR)
+        handler = self.custom_ev_handlers.get(subclass)
+        if handler is None:
+            self.logger.error('Unknown event %s/%s', e.getHeader(EVENT_NAME_HDR), subclass)
+            return
+        try:
+            handler(e)
+        except Exception, ex:
+            self.logger.error('Failed to process event %s/%s: %s', e.getHeader(EVENT_NAME_HDR), subclass, ex)
 
     def handle_create(self, e):
-        uuid = e.getHeader('Unique-ID')
-        self.logger.debug('Created session %s' % uuid)
+        get_header = e.getHeader
+        uuid = get_header(UNIQUE_ID_HDR)
+        self.logger.debug('Created session %s', uuid)
         if uuid in self.sessions:
             return
-        var_uuid = 'variable_%s' % (self.test_uuid_x_header)
-        partner_uuid = e.getHeader(var_uuid)
+        partner_uuid = get_header(self.test_uuid_var)
         if not partner_uuid:
             return
-        if partner_uuid not in self.sessions:
+        sess = self.sessions.get(partner_uuid)
+        if sess is None:
             return
-        self.logger.debug('UUID %s is bridged to UUID %s' % (uuid, partner_uuid))
-        self.sessions[partner_uuid].partner_uuid = uuid
-        self.peer_sessions[uuid] = self.sessions[partner_uuid]
-        self.con.api('uuid_set_var %s %s %s' % (uuid, self.test_id_var, self.test_id))
+        self.logger.debug('UUID %s is bridged to UUID %s', uuid, partner_uuid)
+        sess.partner_uuid = uuid
+        self.sessions[uuid] = sess
+        # Nothing to do with the replies, do not wait for them
+        self.con.sendPipelined(['api uuid_set_var %s %s %s' % (uuid, self.test_id_var, self.test_id)])
 
-    def handle_originate(self, e):
-        uuid = e.getHeader('Unique-ID')
-        if uuid not in self.sessions:
+    def originated_session(self, e):
+        """
+        Account for a CHANNEL_ORIGINATE of one of our sessions, return
+        its uuid and the commands to send for it, (None, None) for
+        calls we did not originate
+        """
+        uuid = e.getHeader(UNIQUE_ID_HDR)
+        sess = self.sessions.get(uuid)
+        if sess is None or sess.uuid != uuid:
             # Ignore call we did not originate
-            return
-        self.logger.debug('Originated session %s' % uuid)
-        self.sessions[uuid].created = True
+            return None, None
+        self.logger.debug('Originated session %s', uuid)
+        sess.created = True
         self.total_originated_sessions = self.total_originated_sessions + 1
         if self.random:
             duration = random.randint(self.random, self.duration)
         else:
             duration = self.duration
-        self.logger.debug('Calculated duration %d for uuid %s' %
-            (duration,uuid))
-        self.con.api('sched_hangup +%d %s NORMAL_CLEARING' % (duration, uuid))
-        if self.dtmf_seq:
-            self.logger.debug('Scheduling DTMF %s with delay %d at uuid %s' % (self.dtmf_seq, self.dtmf_delay, uuid))
-            self.con.api('sched_api +%d none uuid_send_dtmf %s %s' % (self.dtmf_delay, uuid, self.dtmf_seq))
+        self.logger.debug('Calculated duration %d for uuid %s', duration, uuid)
         if self.report_interval and not self.total_originated_sessions % self.report_interval:
-            self.report()
+            self.report_queue.put(self.stats())
+        return uuid, ['api sched_hangup +%d %s NORMAL_CLEARING' % (duration, uuid)]
+
+    def handle_originate(self, e):
+        uuid, cmds = self.originated_session(e)
+        if uuid is not None:
+            self.con.sendPipelined(cmds)
+
+    def handle_originate_dtmf(self, e):
+        """
+        handle_originate() variant used when a DTMF sequence was
+        requested, it also schedules sending the DTMF to the session
+        """
+        uuid, cmds = self.originated_session(e)
+        if uuid is None:
+            return
+        self.logger.debug('Scheduling DTMF %s with delay %d at uuid %s', self.dtmf_seq, self.dtmf_delay, uuid)
+        cmds.append(self.sched_dtmf_template % uuid)
+        self.con.sendPipelined(cmds)
 
     def handle_answer(self, e):
-        uuid = e.getHeader('Unique-ID')
-        if uuid not in self.sessions:
+        uuid = e.getHeader(UNIQUE_ID_HDR)
+        sess = self.sessions.get(uuid)
+        if sess is None or sess.uuid != uuid:
             return
-        self.logger.debug('Answered session %s' % uuid)
+        self.logger.debug('Answered session %s', uuid)
         self.total_answered_sessions = self.total_answered_sessions + 1
-        self.sessions[uuid].answered = True
+        sess.answered = True
 
     def handle_hangup(self, e):
-        uuid = e.getHeader('Unique-ID')
-        if uuid not in self.sessions:
+        get_header = e.getHeader
+        uuid = get_header(UNIQUE_ID_HDR)
+        sess = self.sessions.pop(uuid, None)
+        if sess is None:
             return
-        cause = e.getHeader('Hangup-Cause')
-        if cause not in self.hangup_causes:
-            self.hangup_causes[cause] = 1
-        else:
-            self.hangup_causes[cause] = self.hangup_causes[cause] + 1
-        if not self.sessions[uuid].answered:
+        if sess.uuid != uuid:
+            # Peer leg gone, nothing else to account for
+            return
+        self.active_sessions = self.active_sessions - 1
+        cause = get_header(HANGUP_CAUSE_HDR)
+        self.hangup_causes[cause] += 1
+        if not sess.answered:
             self.total_failed_sessions = self.total_failed_sessions + 1
-        del self.sessions[uuid]
-        self.logger.debug('Hung up session %s' % uuid)
-        if (self.max_sessions and self.total_originated_sessions >= self.max_sessions \
-            and len(self.sessions) == 0):
+        self.logger.debug('Hung up session %s', uuid)
+        # Check the active session counter first, it is non-zero on
+        # almost every hangup so the rest is rarely evaluated
+        if (not self.active_sessions and self.max_sessions \
+            and self.total_originated_sessions >= self.max_sessions):
             self.terminate = True
 
     def handle_bert_lost_sync(self, e):
-        uuid = e.getHeader('Unique-ID')
-        if uuid not in self.sessions:
-            if uuid not in self.peer_sessions:
-                return
-            sess = self.peer_sessions[uuid]
-            partner_uuid = sess.uuid
-        else:
-            sess = self.sessions[uuid]
+        uuid = e.getHeader(UNIQUE_ID_HDR)
+        sess = self.sessions.get(uuid)
+        if sess is None:
+            return
+        if uuid == sess.uuid:
             partner_uuid = sess.partner_uuid
-        self.logger.error('BERT Lost Sync on session %s' % uuid)
+        else:
+            partner_uuid = sess.uuid
+        self.logger.error('BERT Lost Sync on session %s', uuid)
         sess.bert_sync_lost_cnt = sess.bert_sync_lost_cnt + 1
         if sess.bert_sync_lost_cnt > 1:
             return
         # Since mod_bert does not know about the peer session, we set the var ourselves
-        self.con.api('uuid_set_var %s %s true' % (uuid, self.bert_sync_lost_var))
-        self.con.api('uuid_set_var %s %s true' % (partner_uuid, self.bert_sync_lost_var))
+        self.con.sendPipelined(['api uuid_set_var %s %s true' % (uuid, self.bert_sync_lost_var),
+                                'api uuid_set_var %s %s true' % (partner_uuid, self.bert_sync_lost_var)])
 
     def handle_bert_timeout(self, e):
-        uuid = e.getHeader('Unique-ID')
-        if uuid not in self.sessions:
+        uuid = e.getHeader(UNIQUE_ID_HDR)
+        sess = self.sessions.get(uuid)
+        if sess is None or sess.uuid != uuid:
             return
-        self.logger.error('BERT Timeout on session %s' % uuid)
-        self.sessions[uuid].bert_timeout = True
+        self.logger.error('BERT Timeout on session %s', uuid)
+        sess.bert_timeout = True
 
     def handle_disconnect(self):
         self.logger.error('Disconnected from server!')
         self.terminate = True
 
     def hupall(self):
-        self.con.api('bgapi hupall NORMAL_CLEARING %s %s' % (self.test_id_var, str(self.test_id)))
+        self.con.api('bgapi hupall NORMAL_CLEARING %s %s' % (self.test_id_var, self.test_id))
 
     def run(self):
         self.originate_sessions()
+        wakeup_fd = self.wakeup_fds[0]
+        pending = False
         try:
             while True:
-                self.sched.fast_run()
-                e = self.con.recvEventTimed(100)
-                if e is None:
+                if self.next_originate is not None and time.time() >= self.next_originate:
+                    self.originate_sessions()
+                if self.terminate:
+                    break
+                # Sleep until the ESL socket or the signal pipe is readable or
+                # originate_sessions is due (forever once we are done originating)
+                has_queued = pending or self.con.pending()
+                if has_queued:
+                    timeout = 0
+                elif self.next_originate is None:
+                    timeout = None
+                else:
+                    timeout = max(self.next_originate - time.time(), 0)
+                esl_fd = self.con.socketDescriptor()
+                if esl_fd < 0:
+                    # Connection dropped (i.e. a failed write), reconnect()
+                    # sets terminate if it cannot get it back
+                    self.reconnect()
+                    continue
+                try:
+                    ready = select.select([esl_fd, wakeup_fd], [], [], timeout)[0]
+                except select.error, ex:
+                    if ex.args[0] == errno.EINTR:
+                        continue
+                    raise
+                if wakeup_fd in ready:
+                    # The signal handler itself already ran, just empty the pipe
+                    try:
+                        os.read(wakeup_fd, 512)
+                    except OSError:
+                        pass
+                if not has_queued and esl_fd not in ready:
                     continue
-                self.process_event(e)
+                pending = False
+                # Drain whatever is ready, including events buffered or queued
+                # during api() calls which will not make the socket readable
+                recv_event = self.con.recvEventTimed
+                process_event = self.process_event
+                e = recv_event(0)
+                processed = 0
+                while e is not None:
+                    process_event(e)
+                    processed = processed + 1
+                    if self.terminate:
+                        break
+                    if processed >= EVENT_BATCH_MAX:
+                        # There may still be buffered events the socket
+                        # will not signal anymore, come back without sleeping
+                        pending = True
+                        break
+                    e = recv_event(0)
                 if self.terminate:
                     break
+                if e is None and not self.con.connected():
+                    # The socket was readable because the server went away
+                    self.reconnect()
         except:
             self.reconnect()
             self.hupall()
@@ -331,19 +668,47 @@ class SessionManager(object):
     def reconnect(self):
         if self.con.connected():
             return
-        self.con = ESL.ESLconnection(self.server, self.port, self.auth)
+        self.con = ESLConnection(self.server, self.port, self.auth)
         if not self.con.connected():
-            logger.error('Failed to re-connect!')
+            self.logger.error('Failed to re-connect!')
             self.terminate = True
+            return
+        self.setup_connection()
+
+    def stats(self):
+        """
+        Return a snapshot of the counters that can be
+        logged later on by log_report()
+        """
+        return (self.total_originated_sessions, self.total_answered_sessions,
+                self.total_failed_sessions, dict(self.hangup_causes))
+
+    def log_report(self, originated, answered, failed, hangup_causes):
+        # Reports are logged from both the report thread and report(),
+        # keep each one contiguous
+        with self.report_lock:
+            self.logger.info('Total originated sessions: %d', originated)
+            self.logger.info('Total answered sessions: %d', answered)
+            self.logger.info('Total failed sessions: %d', failed)
+            self.logger.info('-- Call Hangup Stats --')
+            for cause, count in hangup_causes.iteritems():
+                self.logger.info('%s: %d', cause, count)
+            self.logger.info('-----------------------')
+
+    def report_worker(self):
+        while True:
+            stats = self.report_queue.get()
+            try:
+                self.log_report(*stats)
+            except Exception, ex:
+                self.logger.error('Failed to log report: %s', ex)
+            finally:
+                self.report_queue.task_done()
 
     def report(self):
-        self.logger.info('Total originated sessions: %d' % self.total_originated_sessions)
-        self.logger.info('Total answered sessions: %d' % self.total_answered_sessions)
-        self.logger.info('Total failed sessions: %d' % self.total_failed_sessions)
-        self.logger.info('-- Call Hangup Stats --')
-        for cause, count in self.hangup_causes.iteritems():
-            self.logger.info('%s: %d' % (cause, count))
-        self.logger.info('-----------------------')
+        # Let pending periodic reports go out first
+        self.report_queue.join()
+        self.log_report(*self.stats())
 
 def main(argv):
 